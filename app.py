@@ -1,9 +1,15 @@
+import gc
+import io
 import os
 import sys
-import json
-import pkg_resources
+import pickle
+import hashlib
+import tempfile
+from functools import partial
+from itertools import chain, groupby
 from operator import itemgetter
-from collections import defaultdict
+from typing import Union, Iterable, Generator
+from concurrent.futures import ThreadPoolExecutor
 
 if not (sys.version_info.major == 3 and sys.version_info.minor >= 9):
     # Ensure we have the Python 3.9 to avoid missing features
@@ -13,74 +19,213 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 9):
     print(f'You are using Python {version.major}.{version.minor}.')
     sys.exit(0)
 
-with open('requirements.txt') as req_file:
-    # Use the requirements.txt file to check if we have all dependencies
-    # for this script to run properly.
 
-    requirements = pkg_resources.parse_requirements(req_file)
-    try:
-        pkg_resources.require([str(r) for r in requirements])
+try:
+    import argh
+    import orjson
+
+except ImportError as err:
+    # the installed versions are only read once an import failed,
+    # reading the metadata of every distribution slows down each run
+    import re
+    import importlib.metadata
+
+    print(err)
 
-    except pkg_resources.DistributionNotFound as err:
-        print(err)
-        print('Please run in the current directory:')
-        print('python -m pip install -r requirements.txt')
-        sys.exit(0)
+    with open('requirements.txt') as req_file:
+        for line in req_file:
+            if not (requirement := line.split('#')[0].strip()):
+                continue
+
+            # the name ends with the version specifiers, IE: ==, >=, ~=
+            name = re.split(r'[^\w.-]', requirement, 1)[0]
+
+            try:
+                installed = importlib.metadata.version(name)
 
+            except importlib.metadata.PackageNotFoundError:
+                installed = 'none'
+
+            print(f'{requirement} is required, {installed} is installed')
+
+    print('Please run in the current directory:')
+    print('python -m pip install -r requirements.txt')
+    sys.exit(0)
 
-import argh
-import boto3
-from terminaltables import AsciiTable
 
 import models
-from schema import create_document
-from exceptions import DuplicateDocument
+from schema import create_documents, dump_index, load_index
 
 
 CACHE_FOLDER = './cache'
 S3_BUCKET_NAME = '1up-coding-challenge-patients'
 
+# number of concurrent downloads, and size of the ranges
+# large objects are split into
+S3_MAX_WORKERS = 32
+S3_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def download_part(client,
+                  part: tuple[str, Union[str, None]]) -> tuple[str, bytes]:
+    """ Download an object, or a byte range of an object, from S3 """
+    key, byte_range = part
+
+    params = {'Bucket': S3_BUCKET_NAME, 'Key': key}
+    if byte_range:
+        params['Range'] = byte_range
+
+    return key, client.get_object(**params)['Body'].read()
+
+
+def iter_documents(chunks: Iterable[bytes]) -> Generator[dict, None, None]:
+    """ Parse the line-delimited JSON documents from the parts of an object
+
+    A line can be split between two parts, the incomplete line at the
+    end of a part is carried over to the next one.
+    """
+    pending = b''
+
+    for chunk in chunks:
+        for line in io.BytesIO(pending + chunk):
+            if not line.endswith(b'\n'):
+                pending = line
+                break
+
+            if line.strip():
+                yield orjson.loads(line)
+        else:
+            pending = b''
+
+    if pending.strip():
+        yield orjson.loads(pending)
+
 
 def load_data(drop_cache: bool = False) -> dict[str, list[dict]]:
     """ Returns a list of documents from cache or from S3 """
 
-    cache_file = CACHE_FOLDER + '/resources.json'
+    cache_file = CACHE_FOLDER + '/resources.pickle'
 
     if not os.path.exists(cache_file) or drop_cache:
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(name=S3_BUCKET_NAME)
+        # only needed when the cache is built, and slow to import
+        import boto3
+        from botocore.config import Config
+
+        # the clients are thread safe, unlike the resources, the pool
+        # needs a connection per download worker (10 by default)
+        config = Config(max_pool_connections=S3_MAX_WORKERS)
+        client = boto3.client('s3', config=config)
+        paginator = client.get_paginator('list_objects_v2')
+
+        # list the objects first, large objects are split in byte ranges
+        # so every part can be downloaded concurrently
+        parts: list[tuple[str, Union[str, None]]] = []
+        for page in paginator.paginate(Bucket=S3_BUCKET_NAME):
+            for o in page.get('Contents', []):
+                key, size = o['Key'], o['Size']
+
+                if size <= S3_CHUNK_SIZE:
+                    parts.append((key, None))
+                    continue
+
+                for start in range(0, size, S3_CHUNK_SIZE):
+                    end = min(start + S3_CHUNK_SIZE, size) - 1
+                    parts.append((key, f'bytes={start}-{end}'))
+
+        resources: dict[str, list[dict]] = {}
+        resource_type, documents = None, []
+        with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as pool:
+            downloads = pool.map(partial(download_part, client), parts)
 
-        resources = defaultdict(list)
-        for o in bucket.objects.all():
-            jstr = [
-                json.loads(n) for n
-                in o.get()['Body'].read().decode("utf-8").split('\n') if n
-            ]
-            for js in jstr:
-                resources[js['resourceType']].append(js)
+            # parts are returned in order, parse the ranges of each object
+            for key, ranges in groupby(downloads, key=itemgetter(0)):
+                chunks = (chunk for _, chunk in ranges)
 
-        with open(cache_file, 'w') as f:
-            f.write(json.dumps(resources, indent=2))
+                for js in iter_documents(chunks):
+                    # the documents come grouped by resource type, only
+                    # look up the list when the type changes
+                    if js['resourceType'] != resource_type:
+                        resource_type = js['resourceType']
+                        documents = resources.setdefault(resource_type, [])
+
+                    documents.append(js)
+
+        # the cache is only read back by this script, pickle saves us
+        # from tokenizing the JSON again on every run
+        with open(cache_file, 'wb') as f:
+            pickle.dump(resources, f, protocol=5)
 
     else:
-        with open(cache_file) as f:
-            resources = json.loads(f.read())
+        with open(cache_file, 'rb') as f:
+            resources = pickle.load(f)
 
     return resources
 
 
+def index_version() -> str:
+    """ Returns the version of the index, it changes with the models """
+    digest = hashlib.sha1()
+
+    for file_name in ('models.py', 'schema.py'):
+        with open(file_name, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
 def init(drop_cache: bool = False):
     """ Initiate the in-memory database with documents fetched from S3 """
 
-    for resource_type, resources in load_data(drop_cache=drop_cache).items():
-        for resource in resources:
-            try:
-                create_document(resource)
+    # The database is made of long-lived containers (documents, reference
+    # sets and search indexes) that are never collected, the garbage
+    # collector would keep walking them while they are created and for
+    # the rest of the run. They are frozen once loaded.
+    gc.disable()
 
-            except DuplicateDocument:
-                # Some duplicated documents?
+    try:
+        index_file = CACHE_FOLDER + '/index.pickle'
+        version = index_version()
+
+        state = None
+        if os.path.exists(index_file) and not drop_cache:
+            try:
+                with open(index_file, 'rb') as f:
+                    # the version is pickled first, the index is only
+                    # loaded if it was built by the current models
+                    if pickle.load(f) == version:
+                        state = pickle.load(f)
+
+            except (EOFError, pickle.UnpicklingError):
+                # an incomplete file, the index is rebuilt
                 pass
 
+        if state is not None:
+            load_index(state)
+            return
+
+        # duplicated documents are skipped
+        resources = load_data(drop_cache).values()
+        create_documents(chain.from_iterable(resources))
+
+        # written aside and moved in place, an interrupted run must not
+        # leave a truncated index behind
+        state = dump_index()
+        with tempfile.NamedTemporaryFile(
+                'wb', dir=CACHE_FOLDER, delete=False) as tmp_file:
+            try:
+                pickle.dump(version, tmp_file)
+                pickle.dump(state, tmp_file, protocol=5)
+
+            except BaseException:
+                os.remove(tmp_file.name)
+                raise
+
+        os.replace(tmp_file.name, index_file)
+
+    finally:
+        gc.freeze()
+        gc.enable()
+
 
 @argh.arg('resource_type', choices=['patient', 'practitioner'],
           help='Select the resource type to search for')
@@ -130,7 +275,9 @@ def search(resource_type: str, terms: str, nocache: bool = False) -> None:
 
     connections = result.get_connections()
     resources = [(name, len(inst)) for name, inst in connections.items()]
-    resources = sorted(resources, key=itemgetter(1))[::-1]
+    resources = sorted(resources, key=itemgetter(1), reverse=True)
+
+    from terminaltables import AsciiTable
 
     headers = ['RESOURCE TYPE', 'COUNT']
     table = AsciiTable([headers, *resources])
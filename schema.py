@@ -1,35 +1,96 @@
+import os
+import sys
+import string
+import weakref
 from collections import defaultdict
-from dataclasses import dataclass, field
-from typing import TypeVar, Union, Generator, Type, cast
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TypeVar, Union, Generator, Iterable, Type, ClassVar, cast
 
 from exceptions import DuplicateDocument, ResourceNotDefined
 
 
-__all__ = ['create_document']
+__all__ = ['create_document', 'create_documents', 'dump_index', 'load_index']
 
 
 T = TypeVar('T')
 
 
-def create_document(data: dict) -> T:
+# punctuation is dropped from the indexed and searched terms
+# IE: "O'Brien" -> "obrien"
+PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+
+def tokenize(terms: Iterable) -> list[str]:
+    """ Split a set of values into lowercased search tokens
+
+    The values are joined and processed at once by the str methods,
+    rather than one by one.
+
+    Example:
+        tokenize(['Zoe', "O'Brien", 3])
+        return ['zoe', 'obrien', '3']
+    """
+    return ' '.join(map(str, terms)).lower().translate(PUNCTUATION).split()
+
+
+@lru_cache(maxsize=None)
+def split_dotkey(key_name: str) -> tuple[str, ...]:
+    """ Split a dotkey notation into its keys
+
+    Example:
+        split_dotkey('participant.individual')
+        return ('participant', 'individual')
+    """
+    return tuple(key_name.split('.'))
+
+
+def create_document(data: dict) -> 'BaseModel':
     """ Helper to create a document from the data received
 
     Required keys:
         resourceType: Corresponding to a defined model
         id: Unique identifier
     """
+    return get_model(data)(id=data['id'], data=data)
+
+
+def create_documents(documents: Iterable[dict]) -> list['BaseModel']:
+    """ Helper to create a batch of documents, see create_document
+
+    Duplicated documents are skipped.
+    """
+    return MetaBaseModel.bulk_load(documents)
+
+
+def get_model(data: dict) -> 'MetaBaseModel':
+    """ Returns the model of the data received, see create_document """
     assert 'resourceType' in data
     assert 'id' in data
 
     resource_type = data['resourceType']
-    document_id = data['id']
-
     base_cls = MetaBaseModel.registered_class.get(resource_type)
 
     if not base_cls:
         raise ResourceNotDefined(resource_type)
 
-    return base_cls['self'](id=document_id, data=data)
+    return base_cls['self']
+
+
+def gil_enabled() -> bool:
+    """ Returns False on a free-threaded build running without the GIL """
+    return getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+def dump_index() -> dict:
+    """ Helper to export the in-memory database, see load_index """
+    return MetaBaseModel.dump_index()
+
+
+def load_index(state: dict) -> None:
+    """ Helper to restore an in-memory database exported by dump_index """
+    MetaBaseModel.load_index(state)
 
 
 class MetaBaseModel(type):
@@ -57,100 +118,221 @@ class MetaBaseModel(type):
     # keep a registry of all the models we have available
     registered_class: dict = {}
 
-    # search index by terms/keywords
-    index_terms: list = []
+    # search index by terms/keywords, partitioned by model
+    # IE: {Patient: {'abernathy': {<Patient>, ...}}}
+    token_index: dict = {}
+
+    # partial (substring) match of the terms, partitioned by model
+    ngram_index: dict = {}
+
+    # load order of the indexed documents, partitioned by model
+    # IE: {Patient: {<Patient>: 0, ...}}
+    index_order: dict = {}
 
     # search index by id key
     index_id: dict = {}
 
+    # search index by id key, partitioned by model
+    index_id_by_cls: dict = {}
+
     # keep track of back references if the instance is not created yet
     _back_references: dict = defaultdict(list)
 
+    # set on every model, see __new__
+    _resource_type_name: str
+    _index_paths: Union[tuple, None]
+
     def __new__(metacls: Type['MetaBaseModel'],
                 clsname: str, bases: tuple,
                 classdict: dict) -> 'MetaBaseModel':
+        # no instance __dict__ for the models, see BaseModel.__slots__
+        classdict.setdefault('__slots__', ())
+
         cls = super().__new__(metacls, clsname, bases, classdict)
-        metacls.registered_class[clsname] = {
+
+        # the resource type of the documents, read for every connection
+        cls._resource_type_name = sys.intern(clsname)
+
+        # compile the dotkeys once, instead of on every document
+        if (index := getattr(cls, 'index', None)) is not None:
+            cls._index_paths = tuple(split_dotkey(k) for k in index)
+        else:
+            cls._index_paths = None
+
+        references = classdict.get('references') or []
+        metacls.registered_class[cls._resource_type_name] = {
             'self': cls,
-            'references': classdict.get('references')
+            'references': tuple(split_dotkey(k) for k in references)
         }
 
         return cast(MetaBaseModel, cls)
 
-    def __call__(cls, *args: list, **kwargs: dict) -> T:
-        # Get the modelname and registered configs
-        registered_class = MetaBaseModel.registered_class[super().__name__]
+    def __call__(cls, *args: list, **kwargs: dict) -> 'BaseModel':
+        document_id, instance = cls._instantiate(*args, **kwargs)
+        cls._link(document_id, instance, kwargs['data'])
 
-        document_id = str(kwargs['id']).lower()
+        return instance
+
+    def _instantiate(cls, *args: list,
+                     **kwargs: dict) -> tuple[str, 'BaseModel']:
+        """ Create and index an instance, without its references """
+
+        # the ids are shared by the indexes and the back references,
+        # interning them keeps a single copy of each
+        document_id = sys.intern(str(kwargs['id']).lower())
         if MetaBaseModel.index_id.get(document_id):
             raise DuplicateDocument(
                 MetaBaseModel.index_id[document_id], document_id)
 
+        instance = cls._create(document_id, *args, **kwargs)
+        MetaBaseModel.index_id[document_id] = instance
+
+        return document_id, instance
+
+    def _create(cls, document_id: str,
+                *args: list, **kwargs: dict) -> 'BaseModel':
+        """ Create an instance and the indexes of its model only """
         instance = super().__call__(*args, **kwargs)
 
         MetaBaseModel.index_instance(instance, kwargs['data'])
 
-        if references := MetaBaseModel._back_references.get(document_id):
+        MetaBaseModel.index_id_by_cls.setdefault(
+            cls, {})[document_id] = instance
+
+        return instance
+
+    def _create_shard(cls,
+                      documents: list[tuple[str, dict]]) -> list['BaseModel']:
+        """ Create a batch of documents of this model, see bulk_load """
+        return [cls._create(document_id, id=data['id'], data=data)
+                for document_id, data in documents]
+
+    def _link(cls, document_id: str,
+              instance: 'BaseModel', data: dict) -> None:
+        """ Set the references of an instance, in both directions """
+
+        # Get the modelname and registered configs
+        registered_class = MetaBaseModel.registered_class[
+            cls._resource_type_name]
+
+        if references := MetaBaseModel._back_references.pop(document_id, None):
             # set the references from previously loaded models
             instance.set_referenced(*references)
 
             for referenced_instance in references:
                 referenced_instance.set_references(instance)
 
-            del MetaBaseModel._back_references[document_id]
-
         if registered_class['references']:
             MetaBaseModel.set_references(
-                instance, kwargs['data'], registered_class['references'])
+                instance, data, registered_class['references'])
 
-        MetaBaseModel.index_id[document_id] = instance
-        return instance
+    @classmethod
+    def bulk_load(cls, documents: Iterable[dict]) -> list['BaseModel']:
+        """ Create a batch of documents in two passes
+
+        All the documents are created and indexed first, then their
+        references are set once every referenced document exists, instead
+        of keeping back references for the ones not created yet.
+        Duplicated documents are skipped.
+
+        The first pass is sharded by model, the shards only touch the
+        indexes of their own model and run in parallel when the GIL
+        is disabled (free-threaded build).
+        """
+        pending = []
+        shards: dict = {}
+        seen = set()
+
+        for data in documents:
+            model = get_model(data)
+            document_id = sys.intern(str(data['id']).lower())
+
+            if document_id in seen or cls.index_id.get(document_id):
+                continue
+
+            seen.add(document_id)
+            shards.setdefault(model, []).append((document_id, data))
+            pending.append((model, document_id, data))
+
+        for model in shards:
+            # the shards must not add any key to the shared indexes
+            cls.index_id_by_cls.setdefault(model, {})
+
+            if model._index_paths is not None:
+                cls.token_index.setdefault(model, {})
+                cls.ngram_index.setdefault(model, NgramIndex())
+                cls.index_order.setdefault(model, {})
+
+        if len(shards) > 1 and not gil_enabled():
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                results = pool.map(
+                    lambda model: model._create_shard(shards[model]), shards)
+                instances = dict(zip(shards, map(iter, results)))
+
+        else:
+            instances = {model: iter(model._create_shard(shard))
+                         for model, shard in shards.items()}
+
+        created = []
+        for model, document_id, data in pending:
+            instance = next(instances[model])
+            cls.index_id[document_id] = instance
+            created.append(instance)
+
+        for (model, document_id, data), instance in zip(pending, created):
+            model._link(document_id, instance, data)
+
+        return created
 
     @classmethod
-    def index_instance(cls, instance: T, data: dict) -> None:
+    def index_instance(cls, instance: 'BaseModel', data: dict) -> None:
         """ Create the search indexes for a model instance """
-        if not hasattr(instance, 'index'):
+        if instance._index_paths is None:
             # if the index attribute is not set in the model
             # there's nothing to do
             return
 
         terms = [data['id']]        # include the ID in all search indexes
-        for key_name in instance.index:
-            keys = key_name.split('.')
-            values = MetaBaseModel.find_key(data, keys)
+        for keys in instance._index_paths:
+            # only the scalar values are indexed, a dotkey resolving to
+            # a dict or a list would index its repr (IE: the key names)
+            terms += [value for value in MetaBaseModel.find_key(data, keys)
+                      if isinstance(value, (str, int, float))]
 
-            if values is None:
-                continue
+        model = type(instance)
+        if (postings := MetaBaseModel.token_index.get(model)) is None:
+            postings = MetaBaseModel.token_index[model] = {}
+            MetaBaseModel.ngram_index[model] = NgramIndex()
+            MetaBaseModel.index_order[model] = {}
 
-            if not isinstance(values, list):
-                values = [values]
+        ngrams = MetaBaseModel.ngram_index[model]
+        order = MetaBaseModel.index_order[model]
+        order[instance] = len(order)
 
-            terms += values
+        # dedupe on the tokens rather than on the raw values
+        tokens = frozenset(tokenize(terms))
 
-        index_terms = ' '.join([str(w).lower() for w in set(terms)])
-        MetaBaseModel.index_terms.append((instance, index_terms))
+        for token in tokens:
+            if token not in postings:
+                # first time we see this token for the model
+                postings[token] = set()
+                ngrams.insert(token)
+
+            postings[token].add(instance)
 
     @classmethod
-    def set_references(cls, instance: T,
-                       data: dict, references: list) -> None:
+    def set_references(cls, instance: 'BaseModel',
+                       data: dict, references: tuple) -> None:
         """ Set the back references for an instance """
 
-        for key_name in references:
-            keys = key_name.split('.')
-            values = MetaBaseModel.find_key(data, keys)
-
-            if values is None:
-                continue
-
-            if not isinstance(values, list):
-                values = [values]
-
-            for reference in values:
+        for keys in references:
+            for reference in MetaBaseModel.find_key(data, keys):
                 if 'reference' not in reference:
                     # TODO: something went wrong, log it
                     continue
 
                 model_name, document_id = reference['reference'].split('/')
+                document_id = sys.intern(document_id)
 
                 if model := cls.index_id.get(document_id):
                     instance.set_references(model)
@@ -160,14 +342,98 @@ class MetaBaseModel(type):
                     # and load the references once the instance is initated
                     cls._back_references[document_id].append(instance)
 
+    @classmethod
+    def dump_index(cls) -> dict:
+        """ Export the documents with their search indexes and references
+
+        The documents are referenced by id so the export can be pickled
+        without walking the whole reference graph.
+        """
+        keys = {instance: key for key, instance in cls.index_id.items()}
+
+        return {
+            'documents': [
+                (instance._resource_type_name, instance.id, instance.data,
+                 [keys[r] for r in instance._references],
+                 [keys[r] for r in instance._referenced])
+                for instance in cls.index_id.values()
+            ],
+            'token_index': {
+                model._resource_type_name: {
+                    token: [keys[i] for i in instances]
+                    for token, instances in postings.items()
+                }
+                for model, postings in cls.token_index.items()
+            },
+            'ngram_index': {
+                model._resource_type_name: ngrams.grams
+                for model, ngrams in cls.ngram_index.items()
+            },
+            'back_references': {
+                document_id: [keys[i] for i in instances]
+                for document_id, instances in cls._back_references.items()
+            },
+        }
+
+    @classmethod
+    def load_index(cls, state: dict) -> None:
+        """ Restore the documents exported by dump_index
+
+        The documents are created without being indexed again,
+        the database is expected to be empty.
+        """
+        models = {name: registered['self']
+                  for name, registered in cls.registered_class.items()}
+
+        index_id = cls.index_id
+        instances = []
+
+        for resource_type, document_id, data, *_ in state['documents']:
+            model = models[resource_type]
+
+            # bypass __call__, the indexes are restored below
+            instance = super(MetaBaseModel, model).__call__(
+                id=document_id, data=data)
+            instances.append(instance)
+
+            document_id = sys.intern(str(document_id).lower())
+            index_id[document_id] = instance
+            cls.index_id_by_cls.setdefault(model, {})[document_id] = instance
+
+        for instance, document in zip(instances, state['documents']):
+            *_, references, referenced = document
+
+            # the sets are new, no need to merge them with set_references
+            instance._references = {index_id[k] for k in references}
+            instance._referenced = {index_id[k] for k in referenced}
+
+        BaseModel._graph_version += 1
+
+        for resource_type, postings in state['token_index'].items():
+            model = models[resource_type]
+            cls.token_index[model] = {
+                token: {cls.index_id[k] for k in keys}
+                for token, keys in postings.items()
+            }
+
+            ngrams = cls.ngram_index[model] = NgramIndex()
+            ngrams.grams = state['ngram_index'][resource_type]
+
+            # the documents are exported in load order
+            order = cls.index_order[model] = {}
+            for instance in cls.index_id_by_cls[model].values():
+                order[instance] = len(order)
+
+        for document_id, keys in state['back_references'].items():
+            cls._back_references[document_id] += [
+                cls.index_id[k] for k in keys]
+
     def get(cls, document_id: str) -> Union[T, None]:
         """ Get a single document by ID """
         document_id = str(document_id).lower()
 
-        if result := MetaBaseModel.index_id.get(document_id):
-
-            if type(result).__name__ == cls.__name__:
-                return result
+        if documents := MetaBaseModel.index_id_by_cls.get(cls):
+            return documents.get(document_id)
 
         # raise ResultNotFound(cls, document_id)
         return None
@@ -175,6 +441,8 @@ class MetaBaseModel(type):
     def find(cls, search_terms: Union[list, str]) -> Generator[T, None, None]:
         """ Find a set of document matching the search terms
 
+        The documents are returned in the order they were loaded.
+
         Example:
             Return patients containing Abernathy in the search index
             Patient.find('Abernathy')
@@ -182,95 +450,255 @@ class MetaBaseModel(type):
         if not isinstance(search_terms, (list, tuple)):
             search_terms = str(search_terms).split(' ')
 
-        search_terms = [str(s).strip().lower()
-                        for s in search_terms if str(s).strip()]
+        search_terms = tokenize(search_terms)
 
-        for instance, index in MetaBaseModel.index_terms:
-            if type(instance).__name__ != cls.__name__:
-                continue
+        postings = MetaBaseModel.token_index.get(cls)
+        if not postings:
+            return
+
+        order = MetaBaseModel.index_order[cls]
 
-            if all(term in index for term in search_terms):
-                # execute a basic word match within the index
-                yield instance
+        if not search_terms:
+            # no terms to match, every document of the model is a match
+            yield from order
+            return
+
+        # each term is matched as a substring of any indexed token,
+        # a document must match all the terms
+        ngrams = MetaBaseModel.ngram_index[cls]
+        matches = []
+        for term in sorted(set(search_terms), key=len, reverse=True):
+            tokens = ngrams.search(term)
+            if not tokens:
+                return
+
+            matches.append(set().union(*[postings[t] for t in tokens]))
+
+        yield from sorted(set.intersection(*matches), key=order.__getitem__)
 
     @staticmethod
-    def find_key(d: Union[dict, list], keys: list) -> Union[list[T], T, None]:
-        """ Traverse a set of keys and return the value
+    def find_key(d: Union[dict, list], keys: tuple) -> list:
+        """ Traverse a set of keys and return the values found
+
+        Lists are traversed transparently, and the values are flattened.
 
         Example:
-            keys = ['a', 'b', 'c']
+            keys = ('a', 'b', 'c')
             data (d) = {'a': {'b': [{'c': 1}, {'c': 2}]}
             return [1, 2]
 
-            keys = ['a', 'b', 'c']
+            keys = ('a', 'b', 'c')
             data (d) = {'a': {'b': {'c': 1}}
-            return 1
+            return [1]
         """
-        if len(keys) <= 1 or (isinstance(d, dict) and not d.get(keys[0])):
-            return d.get(keys[0]) if isinstance(d, dict) else None
-
-        if isinstance(d[keys[0]], list):
-            results = []
-            for o in d[keys[0]]:
-                result = MetaBaseModel.find_key(o, keys[1:])
-                if result is None:
-                    continue
+        # fast path, most dotkeys are a chain of dicts with at most one list
+        node: object = d
+        depth = 0
+        for key in keys:
+            if not isinstance(node, dict):
+                break
 
-                if isinstance(result, list):
-                    for r in result:
-                        results.append(r)
-                else:
-                    results.append(result)
+            if (node := node.get(key)) is None:
+                return []
 
-            return results
+            depth += 1
 
-        result = MetaBaseModel.find_key(d[keys[0]], keys[1:])
-        if result is not None:
-            return result
+        else:
+            return list(node) if isinstance(node, list) else [node]
 
-        return None
+        if not isinstance(node, list):
+            return []
+
+        results = []
+        rest = keys[depth:]
+
+        for item in node:
+            value = item
+            for key in rest:
+                if not isinstance(value, dict):
+                    break
+
+                value = value.get(key)
+
+            else:
+                if isinstance(value, list):
+                    results += value
+
+                elif value is not None:
+                    results.append(value)
+
+                continue
+
+            if isinstance(value, list):
+                # another list was hit, only walk this item with a stack
+                results += MetaBaseModel._walk_keys(item, rest)
+
+        return results
+
+    @staticmethod
+    def _walk_keys(d: Union[dict, list], keys: tuple) -> list:
+        """ Traverse a set of keys through any number of lists, see find_key
+        """
+        results = []
+        last = len(keys) - 1
+
+        # use a stack rather than recursing for each key
+        stack = [(d, 0)]
+        while stack:
+            node, depth = stack.pop()
+
+            if isinstance(node, list):
+                # reversed to keep the document order once popped
+                stack += [(n, depth) for n in reversed(node)]
+                continue
+
+            if not isinstance(node, dict):
+                continue
+
+            if (value := node.get(keys[depth])) is None:
+                continue
+
+            if depth < last:
+                stack.append((value, depth + 1))
+
+            elif isinstance(value, list):
+                results += value
+
+            else:
+                results.append(value)
+
+        return results
+
+
+class NgramIndex:
+    """ Index of the tokens by their n-grams, up to trigrams
+
+    A search term longer than a trigram is looked up by its trigrams, the
+    tokens having all of them are then checked to contain the term.
+    The shorter terms are n-grams themselves and are looked up directly.
+
+    The index grows linearly with the length of the tokens, IE: an id of
+    32 characters is kept in at most 93 n-grams.
+
+    Example:
+        ngrams.insert('aber')
+        ngrams.search('be')
+        return {'aber'}
+    """
+
+    size = 3
 
+    def __init__(self) -> None:
+        self.grams: dict = {}
 
-@dataclass
+    def insert(self, token: str) -> None:
+        grams = self.grams
+
+        for n in range(1, min(self.size, len(token)) + 1):
+            for i in range(len(token) - n + 1):
+                if (tokens := grams.get(gram := token[i:i + n])) is None:
+                    tokens = grams[gram] = set()
+
+                tokens.add(token)
+
+    def search(self, term: str) -> set:
+        if len(term) <= self.size:
+            return self.grams.get(term, set())
+
+        candidates = []
+        for i in range(len(term) - self.size + 1):
+            if not (tokens := self.grams.get(term[i:i + self.size])):
+                return set()
+
+            candidates.append(tokens)
+
+        candidates.sort(key=len)
+        return {token for token in set.intersection(*candidates)
+                if term in token}
+
+
+@dataclass(repr=False)
 class BaseModel(metaclass=MetaBaseModel):
+    # use slots rather than a __dict__ per document, the models get one
+    # empty __slots__ from the metaclass unless they define their own
+    # (dataclass(slots=True) requires Python 3.10)
+    __slots__ = ('id', 'data', '_referenced', '_references', '__weakref__')
+
     id: str
-    data: dict = field(repr=False)
+    data: dict
+
+    # set by the metaclass, see MetaBaseModel.__new__
+    _resource_type_name: ClassVar[str]
+    _index_paths: ClassVar[Union[tuple, None]]
 
-    # back reference models (parents)
-    # this attribute will hold all instances where this instance is referenced
-    _referenced: set = field(default_factory=set, init=False, repr=False)
+    # memoized connections per document, with the graph version they
+    # were computed at, any new reference invalidates all of them
+    _connections_cache: ClassVar[
+        'weakref.WeakKeyDictionary[BaseModel, tuple[int, defaultdict]]'
+    ] = weakref.WeakKeyDictionary()
+    _graph_version = 0
 
-    # referenced models (children)
-    # this attribute will hold all instances referenced in this model
-    _references: set = field(default_factory=set, init=False, repr=False)
+    def __post_init__(self) -> None:
+        # back reference models (parents)
+        # this attribute will hold all instances where this instance
+        # is referenced
+        self._referenced: set = set()
+
+        # referenced models (children)
+        # this attribute will hold all instances referenced in this model
+        self._references: set = set()
 
     def set_references(self, *references: tuple) -> None:
         self._references |= set(references)
+        BaseModel._graph_version += 1
 
     def set_referenced(self, *referenced: tuple) -> None:
         self._referenced |= set(referenced)
+        BaseModel._graph_version += 1
 
     def traverse_references(self, references) -> set:
-        """ Get all references with optionally traversing all children """
-        _references = set()
+        """ Get all references with optionally traversing all children
+
+        Each document is visited once, shared children and reference
+        cycles are not walked again.
+        """
+        visited = set()
+        stack = list(references)
+
+        while stack:
+            if (reference := stack.pop()) in visited:
+                continue
 
-        for reference in references:
-            _references |= reference.traverse_references(reference._references)
+            visited.add(reference)
+            stack += reference._references
 
-        return references | _references
+        return visited
 
     def get_connections(self) -> defaultdict[str, set]:
-        connections = defaultdict(set)
+        """ Get the connected documents grouped by resource type
 
-        all_connections = self.traverse_references(self._references)
-        all_connections |= self.traverse_references(self._referenced)
+        The result is memoized until a reference is added to any document,
+        it is shared between calls and should not be modified.
+        """
+        cached = self._connections_cache.get(self)
+        if cached and cached[0] == BaseModel._graph_version:
+            return cached[1]
+
+        connections: defaultdict[str, set] = defaultdict(set)
+
+        all_connections = self.traverse_references(
+            self._references | self._referenced)
 
         for connection in all_connections:
             if connection != self:
-                connections[type(connection).__name__].add(connection)
+                connections[connection._resource_type_name].add(connection)
 
+        self._connections_cache[self] = (BaseModel._graph_version, connections)
         return connections
 
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(id={self.id!r})'
+
     def __eq__(self, other):
         return self.id == other.id
 
@@ -1,5 +1,12 @@
+import io
+import uuid
+import pickle
+import tempfile
 import unittest
+from unittest import mock
+from collections import defaultdict
 
+import app
 import schema
 from exceptions import ResourceNotDefined
 
@@ -107,6 +114,18 @@ class TestCreateDocument(unittest.TestCase):
         results = MockSearchModel01.find('zebra yebra')
         self.assertEqual(len(list(results)), 0)
 
+        results = MockSearchModel01.find('ebr')
+        self.assertEqual(list(results), [doc01, doc03])
+
+        results = MockSearchModel01.find('ebr ach')
+        self.assertEqual(len(list(results)), 0)
+
+        results = MockSearchModel01.find('')
+        self.assertEqual(list(results), [doc01, doc03, doc04])
+
+        results = MockSearchModel01.find('a')
+        self.assertEqual(list(results), [doc01, doc03, doc04])
+
         result = MockSearchModel01.get('AAI03')
         self.assertEqual(result, doc03)
 
@@ -116,14 +135,40 @@ class TestCreateDocument(unittest.TestCase):
         result = MockSearchModel01.get(4)
         self.assertEqual(result, doc04)
 
+        result = MockSearchModel02.get(4)
+        self.assertIsNone(result)
+
         results = MockSearchModel01.find('AAI03')
         self.assertEqual(list(results), [doc03])
 
+        results = MockSearchModel01.find('zoe, aber!')
+        self.assertEqual(list(results), [doc01])
+
         results = MockSearchModel02.find('zoe')
         results = list(results)
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0], doc02)
 
+    def test_search_unhashable_values(self):
+        doc = schema.create_document({
+            'id': 'bbb01',
+            'resourceType': 'MockSearchModel03',
+            'name': [{
+                'given': ['Zoe', 'Zoe'],
+                'family': 'Aber'
+            }]
+        })
+
+        # the dicts are not indexed, only the scalar values
+        results = MockSearchModel03.find('given')
+        self.assertEqual(list(results), [])
+
+        results = MockSearchModel03.find('zoe')
+        self.assertEqual(list(results), [])
+
+        results = MockSearchModel03.find('bbb01')
+        self.assertEqual(list(results), [doc])
+
     def test_references(self):
 
         parent = schema.create_document({
@@ -173,6 +218,298 @@ class TestCreateDocument(unittest.TestCase):
         references = patient.get_connections()
         self.assertDictEqual(references, patient_references)
 
+        self.assertIs(patient.get_connections(), references)
+
+        document_child = schema.create_document({
+            'id': 106,
+            'resourceType': 'MockReferenceDocument',
+        })
+        document.set_references(document_child)
+
+        patient_references['MockReferenceDocument'].add(document_child)
+        references = patient.get_connections()
+        self.assertDictEqual(references, patient_references)
+
+    def test_references_cycle(self):
+        first = schema.create_document({
+            'id': 201,
+            'resourceType': 'MockReferenceCycle',
+            'next': {'reference': 'MockReferenceCycle/202'}
+        })
+
+        second = schema.create_document({
+            'id': 202,
+            'resourceType': 'MockReferenceCycle',
+            'next': {'reference': 'MockReferenceCycle/201'}
+        })
+
+        references = first.get_connections()
+        self.assertDictEqual(references, {'MockReferenceCycle': {second}})
+
+
+class TestCreateDocuments(unittest.TestCase):
+    def test_create_documents(self):
+        documents = schema.create_documents([{
+            'id': 301,
+            'resourceType': 'MockBulkParent',
+            'child': {'reference': 'MockBulkChild/302'}
+        }, {
+            'id': 302,
+            'resourceType': 'MockBulkChild'
+        }, {
+            'id': 302,
+            'resourceType': 'MockBulkChild'
+        }])
+
+        self.assertEqual(len(documents), 2)
+        parent, child = documents
+
+        self.assertNotIn('302', schema.MetaBaseModel._back_references)
+        self.assertEqual(MockBulkChild.get(302), child)
+        self.assertDictEqual(parent.get_connections(),
+                             {'MockBulkChild': {child}})
+        self.assertDictEqual(child.get_connections(),
+                             {'MockBulkParent': {parent}})
+
+        # the models without an index have no search indexes
+        self.assertNotIn(MockBulkChild, schema.MetaBaseModel.token_index)
+        self.assertNotIn(MockBulkChild, schema.MetaBaseModel.index_order)
+
+        self.assertRaises(ResourceNotDefined, schema.create_documents, [{
+            'id': 303,
+            'resourceType': 'MockModelDontExists'
+        }])
+
+    @mock.patch('schema.gil_enabled', return_value=False)
+    def test_create_documents_parallel(self, gil_enabled):
+        documents = schema.create_documents([{
+            'id': 311,
+            'resourceType': 'MockBulkParent',
+            'child': {'reference': 'MockBulkChild/312'}
+        }, {
+            'id': 312,
+            'resourceType': 'MockBulkChild'
+        }, {
+            'id': 313,
+            'resourceType': 'MockBulkParent',
+            'child': {'reference': 'MockBulkChild/312'}
+        }])
+
+        self.assertTrue(gil_enabled.called)
+        self.assertEqual([d.id for d in documents], [311, 312, 313])
+
+        parent01, child, parent02 = documents
+        self.assertEqual(MockBulkParent.get(313), parent02)
+        self.assertDictEqual(child.get_connections(),
+                             {'MockBulkParent': {parent01, parent02}})
+
+
+class TestDumpIndex(unittest.TestCase):
+    def test_dump_load_index(self):
+        parent = schema.create_document({
+            'id': 'ccc01',
+            'resourceType': 'MockIndexParent',
+            'name': [{'given': ['Zoe'], 'family': 'Index'}],
+            'child': {'reference': 'MockIndexChild/ccc02'}
+        })
+
+        child = schema.create_document({
+            'id': 'ccc02',
+            'resourceType': 'MockIndexChild',
+            'missing': {'reference': 'MockIndexChild/ccc03'}
+        })
+
+        state = pickle.loads(pickle.dumps(schema.dump_index()))
+
+        with mock.patch.multiple(schema.MetaBaseModel,
+                                 token_index={}, ngram_index={},
+                                 index_order={},
+                                 index_id={}, index_id_by_cls={},
+                                 _back_references=defaultdict(list)):
+
+            self.assertIsNone(MockIndexParent.get('ccc01'))
+
+            schema.load_index(state)
+
+            result = MockIndexParent.get('CCC01')
+            self.assertEqual(result, parent)
+            self.assertIsNot(result, parent)
+
+            self.assertEqual(list(MockIndexParent.find('zoe ind')), [parent])
+            self.assertEqual(list(MockIndexParent.find('')), [parent])
+            self.assertDictEqual(result.get_connections(),
+                                 {'MockIndexChild': {child}})
+
+            references = schema.MetaBaseModel._back_references['ccc03']
+            self.assertEqual(references, [child])
+
+    def test_init_truncated_index(self):
+        resources = {'MockIndexChild': [{
+            'id': 'ccc04',
+            'resourceType': 'MockIndexChild'
+        }]}
+
+        def clear_index():
+            return mock.patch.multiple(schema.MetaBaseModel,
+                                       token_index={}, ngram_index={},
+                                       index_order={},
+                                       index_id={}, index_id_by_cls={},
+                                       _back_references=defaultdict(list))
+
+        with tempfile.TemporaryDirectory() as folder, \
+                mock.patch.object(app, 'CACHE_FOLDER', folder), \
+                mock.patch.object(app, 'load_data',
+                                  return_value=resources) as load_data:
+
+            # the version was written, not the index
+            with open(folder + '/index.pickle', 'wb') as f:
+                pickle.dump(app.index_version(), f)
+
+            with clear_index():
+                app.init()
+                load_data.assert_called_once()
+                self.assertIsNotNone(MockIndexChild.get('ccc04'))
+
+            # the rebuilt index is loaded on the next run
+            with clear_index():
+                app.init()
+                load_data.assert_called_once()
+                self.assertIsNotNone(MockIndexChild.get('ccc04'))
+
+
+class TestNgramIndex(unittest.TestCase):
+    def test_search(self):
+        ngrams = schema.NgramIndex()
+        ngrams.insert('aber')
+        ngrams.insert('zebra')
+
+        self.assertEqual(ngrams.search('b'), {'aber', 'zebra'})
+        self.assertEqual(ngrams.search('be'), {'aber'})
+        self.assertEqual(ngrams.search('ebra'), {'zebra'})
+        self.assertEqual(ngrams.search('abe'), {'aber'})
+        self.assertEqual(ngrams.search('aberz'), set())
+        self.assertEqual(ngrams.search('bra'), {'zebra'})
+
+    def test_size(self):
+        # the index must grow linearly with the length of the ids
+        ngrams = schema.NgramIndex()
+        tokens = [uuid.uuid4().hex for _ in range(1000)]
+
+        for token in tokens:
+            ngrams.insert(token)
+
+        size = sum(len(t) for t in ngrams.grams.values())
+        self.assertLessEqual(size, 93 * len(tokens))
+
+        for token in tokens[:10]:
+            self.assertEqual(ngrams.search(token), {token})
+            self.assertIn(token, ngrams.search(token[5:20]))
+
+
+class TestLoadData(unittest.TestCase):
+    def test_iter_documents(self):
+        chunks = [b'{"id": 1}\n{"id"', b': 2}\n', b'\n{"id": 3}']
+        documents = list(app.iter_documents(chunks))
+        self.assertEqual(documents, [{'id': 1}, {'id': 2}, {'id': 3}])
+
+        # a line split in more than two parts
+        chunks = [b'{"id": 1}\n{"i', b'd": ', b'2}', b'\n']
+        documents = list(app.iter_documents(chunks))
+        self.assertEqual(documents, [{'id': 1}, {'id': 2}])
+
+        chunks = [b'{"id": 1}', b'']
+        documents = list(app.iter_documents(chunks))
+        self.assertEqual(documents, [{'id': 1}])
+
+        self.assertEqual(list(app.iter_documents([])), [])
+
+    def test_download_part(self):
+        client = mock.Mock()
+        client.get_object.return_value = {'Body': io.BytesIO(b'{}')}
+
+        result = app.download_part(client, ('key', 'bytes=0-1'))
+        self.assertEqual(result, ('key', b'{}'))
+        client.get_object.assert_called_with(
+            Bucket=app.S3_BUCKET_NAME, Key='key', Range='bytes=0-1')
+
+        client.get_object.return_value = {'Body': io.BytesIO(b'{}')}
+        app.download_part(client, ('key', None))
+        client.get_object.assert_called_with(
+            Bucket=app.S3_BUCKET_NAME, Key='key')
+
+
+class TestLoadDataS3(unittest.TestCase):
+    objects = {
+        'a': b'{"resourceType": "Patient", "id": 1}\n',
+        'b': (b'{"resourceType": "Patient", "id": 2}\n'
+              b'{"resourceType": "Encounter", "id": 3}\n'),
+    }
+
+    def get_object(self, Bucket, Key, Range=None):
+        body = self.objects[Key]
+
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+
+        return {'Body': io.BytesIO(body)}
+
+    @mock.patch('app.S3_CHUNK_SIZE', 16)
+    @mock.patch('boto3.client')
+    def test_load_data(self, client_factory):
+        client = client_factory.return_value
+        client.get_object.side_effect = self.get_object
+        client.get_paginator.return_value.paginate.return_value = [{
+            'Contents': [{'Key': 'a', 'Size': len(self.objects['a'])}]
+        }, {
+            'Contents': [{'Key': 'b', 'Size': len(self.objects['b'])}]
+        }]
+
+        with tempfile.TemporaryDirectory() as folder, \
+                mock.patch('app.CACHE_FOLDER', folder):
+            resources = app.load_data()
+
+        # listed and downloaded by the same client, with a connection
+        # per download worker
+        config = client_factory.call_args.kwargs['config']
+        self.assertEqual(config.max_pool_connections, app.S3_MAX_WORKERS)
+        client.get_paginator.assert_called_with('list_objects_v2')
+
+        # the objects larger than a chunk are downloaded in ranges
+        ranges = [(c.kwargs['Key'], c.kwargs['Range'])
+                  for c in client.get_object.call_args_list]
+        self.assertIn(('a', 'bytes=0-15'), ranges)
+        self.assertIn(('a', 'bytes=32-36'), ranges)
+        self.assertEqual(len(ranges), 3 + 5)
+
+        self.assertEqual(resources, {
+            'Patient': [{'resourceType': 'Patient', 'id': 1},
+                        {'resourceType': 'Patient', 'id': 2}],
+            'Encounter': [{'resourceType': 'Encounter', 'id': 3}],
+        })
+
+
+class TestFindKey(unittest.TestCase):
+    def test_find_key(self):
+        find_key = schema.MetaBaseModel.find_key
+
+        data = {'a': {'b': [{'c': 1}, {'c': 2}, {'d': 3}]}}
+        self.assertEqual(find_key(data, ('a', 'b', 'c')), [1, 2])
+
+        data = {'a': {'b': {'c': 1}}}
+        self.assertEqual(find_key(data, ('a', 'b', 'c')), [1])
+        self.assertEqual(find_key(data, ('a', 'c')), [])
+
+        data = {'a': [{'b': ['x', 'y']}, {'b': 'z'}]}
+        self.assertEqual(find_key(data, ('a', 'b')), ['x', 'y', 'z'])
+
+        data = {'a': None}
+        self.assertEqual(find_key(data, ('a', 'b')), [])
+
+        # lists nested in a list, in the document order
+        data = {'a': [{'b': [{'c': 1}, [{'c': 2}]]}, {'b': {'c': 3}}, 'x']}
+        self.assertEqual(find_key(data, ('a', 'b', 'c')), [1, 2, 3])
+
 
 class MockModel01(schema.BaseModel):
     pass
@@ -186,6 +523,27 @@ class MockSearchModel02(schema.BaseModel):
     index = ['name.given', 'name.family']
 
 
+class MockSearchModel03(schema.BaseModel):
+    index = ['name']
+
+
+class MockBulkParent(schema.BaseModel):
+    references = ['child']
+
+
+class MockBulkChild(schema.BaseModel):
+    pass
+
+
+class MockIndexParent(schema.BaseModel):
+    index = ['name.given', 'name.family']
+    references = ['child']
+
+
+class MockIndexChild(schema.BaseModel):
+    references = ['missing']
+
+
 class MockReferenceParent(schema.BaseModel):
     references = ['patient', 'careteam']
 
@@ -194,6 +552,10 @@ class MockReferencePatient(schema.BaseModel):
     references = ['document']
 
 
+class MockReferenceCycle(schema.BaseModel):
+    references = ['next']
+
+
 class MockReferenceCareTeam(schema.BaseModel):
     pass
 